@@ -18,11 +18,14 @@
 # Refer to the README and COPYING files for full details of the license
 #
 import ConfigParser
+import fcntl
 import functools
+import hashlib
+import json
 import logging
 import os
+import time
 
-import lockfile
 import nose.core
 import nose.config
 from ovirtsdk.infrastructure.errors import RequestError
@@ -45,30 +48,112 @@ def _with_repo_server(func):
     return wrapper
 
 
-def _sync_rpm_repository(repo_path, yum_config, repos):
-    lock_path = os.path.join(repo_path, '.lock')
+def _sync_repo(repo_path, yum_config, repo, log_dir):
+    lock_path = os.path.join(repo_path, '.lock.%s' % repo)
 
-    if not os.path.exists(repo_path):
-        os.makedirs(repo_path)
+    # flock does not need write access, and the cache is shared by all the
+    # testenv group members, so don't require owning the lock file
+    fd = os.open(lock_path, os.O_RDONLY | os.O_CREAT, 0664)
+    try:
+        # Only one process gets to run reposync on a repo, the rest wait
+        # for it to finish and just verify the result. Verification is done
+        # under LOCK_SH so nobody can reposync the repo in the meantime
+        if utils.try_flock(fd, fcntl.LOCK_EX):
+            ret, out, _ = utils.run_command_to_file(
+                [
+                    'reposync',
+                    '--config=%s' % yum_config,
+                    '--download_path=%s' % repo_path,
+                    '--newest-only',
+                    '--delete',
+                    '--repoid=%s' % repo,
+                ],
+                os.path.join(log_dir, 'reposync-%s.log' % repo),
+            )
+            if not ret:
+                return
+
+            logging.debug('reposync of %s output was: \n%s', repo, out)
+        else:
+            logging.info(
+                '%s is being synced by another process, waiting',
+                repo,
+            )
 
-    with lockfile.LockFile(lock_path):
-        ret, _, _ = utils.run_command(
-            [
-                'reposync',
-                '--config=%s' % yum_config,
-                '--download_path=%s' % repo_path,
-                '--newest-only',
-                '--delete',
-            ] + [
-                '--repoid=%s' % repo
-                for repo in repos
-            ],
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        repoverify.verify_reposync(yum_config, repo_path, [repo])
+    finally:
+        os.close(fd)
+
+
+def _reposync_config_hash(yum_config, repos):
+    with open(yum_config) as f:
+        config = f.read()
+    return hashlib.sha256(config + '\0'.join(sorted(repos))).hexdigest()
+
+
+def _reposync_is_fresh(stamp_path, config_hash):
+    ttl = int(testenv.config.get('reposync_cache_ttl', 300))
+    try:
+        with open(stamp_path) as f:
+            stamp = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    return (
+        stamp.get('config_sha256') == config_hash
+        and
+        time.time() - stamp.get('mtime', 0) < ttl
+    )
+
+
+def _write_reposync_stamp(stamp_path, config_hash, repos, mtime):
+    tmp_path = '%s.%d' % (stamp_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        testenv.utils.json_dump(
+            {
+                'config_sha256': config_hash,
+                'repos': sorted(repos),
+                'mtime': mtime,
+            },
+            f,
         )
-        if ret:
-            repoverify.verify_reposync(yum_config, repo_path, repos)
+    os.rename(tmp_path, stamp_path)
+
 
+def _sync_rpm_repository(repo_path, yum_config, repos, log_dir):
+    stamp_path = os.path.join(repo_path, '.reposync.stamp')
 
-def _build_rpms(name, script, source_dir, output_dir, dists, env=None):
+    testenv.utils.mkdir_p(repo_path)
+
+    config_hash = _reposync_config_hash(yum_config, repos)
+    if _reposync_is_fresh(stamp_path, config_hash):
+        logging.info('%s was synced recently, skipping reposync', repo_path)
+        return
+
+    sync_time = time.time()
+    vt = testenv.utils.VectorThread(
+        testenv.utils.func_vector(
+            _sync_repo,
+            [(repo_path, yum_config, repo, log_dir) for repo in repos],
+        )
+    )
+    vt.start_all()
+    vt.join_all()
+
+    _write_reposync_stamp(stamp_path, config_hash, repos, sync_time)
+
+
+def _build_rpms(
+    name,
+    script,
+    source_dir,
+    output_dir,
+    dists,
+    log_dir,
+    env=None,
+):
+    log_path = os.path.join(log_dir, 'build-%s.log' % name)
     logging.info(
         'Building %s(%s) from %s, for %s, storing results in %s',
         name,
@@ -77,12 +162,13 @@ def _build_rpms(name, script, source_dir, output_dir, dists, env=None):
         ', '.join(dists),
         output_dir,
     )
-    ret, out, err = utils.run_command(
+    ret, out, _ = utils.run_command_to_file(
         [
             script,
             source_dir,
             output_dir,
         ] + dists,
+        log_path,
         env=env,
     )
 
@@ -92,44 +178,88 @@ def _build_rpms(name, script, source_dir, output_dir, dists, env=None):
             script,
             ret,
         )
-        logging.error('Output was: \n%s', out)
-        logging.error('Errors were: \n%s', err)
+        logging.error('Last output was: \n%s', out)
+        logging.error('Full output is in %s', log_path)
         raise RuntimeError('%s failed, see logs' % script)
 
     return ret
 
 
-def _build_vdsm_rpms(vdsm_dir, output_dir, dists):
-    _build_rpms('vdsm', 'build_vdsm_rpms.sh', vdsm_dir, output_dir, dists)
+def _build_vdsm_rpms(vdsm_dir, output_dir, dists, log_dir):
+    _build_rpms(
+        'vdsm',
+        'build_vdsm_rpms.sh',
+        vdsm_dir,
+        output_dir,
+        dists,
+        log_dir,
+    )
 
 
-def _build_engine_rpms(engine_dir, output_dir, dists, build_gwt=False):
-    env = os.environ.copy()
-    if build_gwt:
-        env['BUILD_GWT'] = '1'
-    else:
-        env['BUILD_GWT'] = '0'
+def _build_engine_rpms(
+    engine_dir,
+    output_dir,
+    dists,
+    log_dir,
+    build_gwt=False,
+):
+    env = dict(os.environ, BUILD_GWT=build_gwt and '1' or '0')
     _build_rpms(
         'ovirt-engine',
         'build_engine_rpms.sh',
         engine_dir,
         output_dir,
         dists,
+        log_dir,
         env
     )
 
 
-def _build_vdsm_jsonrpc_java_rpms(source_dir, output_dir, dists):
+def _build_vdsm_jsonrpc_java_rpms(source_dir, output_dir, dists, log_dir):
     _build_rpms(
         'vdsm-jsonrpc-java',
         'build_vdsm-jsonrpc-java_rpms.sh',
         source_dir,
         output_dir,
-        dists
+        dists,
+        log_dir,
     )
 
 
+def _read_git_revision(path):
+    git_dir = os.path.join(path, '.git')
+    with open(os.path.join(git_dir, 'HEAD')) as f:
+        head = f.read().strip()
+
+    # Detached HEAD holds the revision itself
+    if not head.startswith('ref: '):
+        return head
+
+    ref = head[len('ref: '):]
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return f.read().strip()
+    except IOError:
+        pass
+
+    with open(os.path.join(git_dir, 'packed-refs')) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and fields[1] == ref:
+                return fields[0]
+    return None
+
+
 def _git_revision_at(path):
+    # Reading the refs is enough for plain checkouts, anything else
+    # (worktrees, submodules, ...) is left to git
+    try:
+        revision = _read_git_revision(path)
+    except IOError:
+        revision = None
+    if revision:
+        return revision
+
     ret, out, _ = utils.run_command(
         ['git', 'rev-parse', 'HEAD'],
         cwd=path
@@ -139,55 +269,79 @@ def _git_revision_at(path):
     return out.strip()
 
 
-def _activate_storage_domains(api, sds):
+def _all_sds_in_state(dc, names, state):
+    states = {sd.name: sd.status.state for sd in dc.storagedomains.list()}
+    return all(states.get(name) == state for name in names)
+
+
+def _all_hosts_in_state(api, names, state):
+    states = {host.name: host.status.state for host in api.hosts.list()}
+    return all(states.get(name) == state for name in names)
+
+
+def _activate_storage_domains(dc, sds):
+    if not sds:
+        return
+
     for sd in sds:
         sd.activate()
 
-    for sd in sds:
-        dc = api.datacenters.get(
-            id=sd.get_data_center().get_id(),
-        )
-        testlib.assert_true_within_long(
-            lambda: dc.storagedomains.get(sd.name).status.state == 'active',
-        )
+    names = [sd.name for sd in sds]
+    testlib.assert_true_within_long(
+        functools.partial(_all_sds_in_state, dc, names, 'active'),
+    )
+
 
+def _deactivate_storage_domains(dc, sds):
+    if not sds:
+        return
 
-def _deactivate_storage_domains(api, sds):
     for sd in sds:
         sd.deactivate()
 
-    for sd in sds:
-        dc = api.datacenters.get(id=sd.get_data_center().get_id())
-        testlib.assert_true_within_long(
-            lambda:
-            dc.storagedomains.get(sd.name).status.state == 'maintenance',
-        )
+    names = [sd.name for sd in sds]
+    testlib.assert_true_within_long(
+        functools.partial(_all_sds_in_state, dc, names, 'maintenance'),
+    )
 
 
 def _deactivate_all_storage_domains(api):
     for dc in api.datacenters.list():
         sds = dc.storagedomains.list()
-        _deactivate_storage_domains(api, [sd for sd in sds if not sd.master])
-        _deactivate_storage_domains(api, [sd for sd in sds if sd.master])
+        _deactivate_storage_domains(dc, [sd for sd in sds if not sd.master])
+        _deactivate_storage_domains(dc, [sd for sd in sds if sd.master])
+
+
+def _deactivate_host(host):
+    try:
+        host.deactivate()
+        logging.info('Sent host %s to maintenance', host.name)
+        return True
+    except RequestError:
+        logging.exception('Failed to maintenance host %s', host.name)
+        return False
 
 
 def _deactivate_all_hosts(api):
     hosts = api.hosts.list()
+    names = [host.name for host in hosts]
 
+    # Hosts that were refused are retried once the rest of the round is done
     while hosts:
-        host = hosts.pop()
-        try:
-            host.deactivate()
-            logging.info('Sent host %s to maintenance', host.name)
-        except RequestError:
-            logging.exception('Failed to maintenance host %s', host.name)
-            hosts.insert(0, host)
-
-    for host in api.hosts.list():
-        logging.debug('Waiting for %s to go into maintenance', host.name)
-        testlib.assert_true_within_short(
-            lambda: api.hosts.get(host.name).status.state == 'maintenance',
+        vt = testenv.utils.VectorThread(
+            testenv.utils.func_vector(
+                _deactivate_host,
+                [(host,) for host in hosts],
+            )
         )
+        vt.start_all()
+        results = vt.join_all()
+        hosts = [host for host, ok in zip(hosts, results) if not ok]
+
+    logging.debug('Waiting for %s to go into maintenance', ', '.join(names))
+    testlib.assert_true_within_short(
+        functools.partial(_all_hosts_in_state, api, names, 'maintenance'),
+    )
 
 
 def _activate_all_hosts(api):
@@ -199,17 +353,28 @@ def _activate_all_hosts(api):
         except RequestError:
             pass
 
-    for name in names:
-        testlib.assert_true_within_short(
-            lambda: api.hosts.get(name).status.state == 'up',
-        )
+    testlib.assert_true_within_short(
+        functools.partial(_all_hosts_in_state, api, names, 'up'),
+    )
 
 
 def _activate_all_storage_domains(api):
     for dc in api.datacenters.list():
         sds = dc.storagedomains.list()
-        _activate_storage_domains(api, [sd for sd in sds if sd.master])
-        _activate_storage_domains(api, [sd for sd in sds if not sd.master])
+        _activate_storage_domains(dc, [sd for sd in sds if sd.master])
+        _activate_storage_domains(dc, [sd for sd in sds if not sd.master])
+
+
+def _run_deploy_script(host, script):
+    ret, _, _ = host.ssh_script(script, show_output=False)
+    if ret != 0:
+        raise RuntimeError(
+            '%s failed with status %d on %s' % (
+                script,
+                ret,
+                host.name(),
+            ),
+        )
 
 
 class OvirtPrefix(testenv.Prefix):
@@ -224,8 +389,8 @@ class OvirtPrefix(testenv.Prefix):
             rollback.prependDefer(self._activate)
 
             logging.info('Creating snapshots')
-            # stop engine:
-            engine.service('ovirt-engine').stop()
+            # The engine is restarted after the VDSMs, so its rollback is
+            # registered before any of theirs
             rollback.prependDefer(engine.get_api)
             rollback.prependDefer(engine.service('ovirt-engine').start)
 
@@ -237,9 +402,17 @@ class OvirtPrefix(testenv.Prefix):
                 host.service('supervdsmd').stop()
                 rollback.prependDefer(host.service('supervdsmd').start)
 
-            vec = testenv.utils.func_vector(
-                stop_host,
-                [(vm,) for vm in self.virt_env.host_vms()],
+            # stop engine together with the VDSMs:
+            def stop_engine():
+                engine.service('ovirt-engine').stop()
+                engine.invalidate_api()
+
+            vec = [stop_engine]
+            vec.extend(
+                testenv.utils.func_vector(
+                    stop_host,
+                    [(vm,) for vm in self.virt_env.host_vms()],
+                )
             )
             vt = testenv.utils.VectorThread(vec)
             vt.start_all()
@@ -255,6 +428,7 @@ class OvirtPrefix(testenv.Prefix):
         self._activate()
 
     def _create_rpm_repository(self, dists, repos_path, repo_names):
+        merges = []
         for dist in dists:
             dist_output = self.paths.internal_repo(dist)
             rpm_dirs = []
@@ -268,6 +442,14 @@ class OvirtPrefix(testenv.Prefix):
                 rpm_dirs.append(
                     os.path.join(self.paths.build_dir('ovirt-engine'), dist)
                 )
+
+            if os.path.exists(self.paths.build_dir('vdsm-jsonrpc-java')):
+                rpm_dirs.append(
+                    os.path.join(
+                        self.paths.build_dir('vdsm-jsonrpc-java'),
+                        dist,
+                    )
+                )
             rpm_dirs.extend(
                 [
                     os.path.join(repos_path, name)
@@ -276,7 +458,15 @@ class OvirtPrefix(testenv.Prefix):
                 ],
             )
 
-            merge_repos.merge(dist_output, rpm_dirs)
+            merges.append((dist_output, rpm_dirs))
+
+        # Create the common parent first, the merges would race on it
+        testenv.utils.mkdir_p(self.paths.internal_repo())
+        vt = testenv.utils.VectorThread(
+            testenv.utils.func_vector(merge_repos.merge, merges)
+        )
+        vt.start_all()
+        vt.join_all()
 
     def prepare_repo(
         self,
@@ -288,17 +478,17 @@ class OvirtPrefix(testenv.Prefix):
         engine_build_gwt=None,
         vdsm_jsonrpc_java_dir=None,
     ):
+        engine = self.virt_env.engine_vm()
+        hosts = self.virt_env.host_vms()
+
         # Detect distros from template metadata
         engine_dists = []
-        if self.virt_env.engine_vm():
-            engine_dists.append(self.virt_env.engine_vm().distro())
+        if engine:
+            engine_dists.append(engine.distro())
 
-        vdsm_dists = []
-        for host in self.virt_env.host_vms():
-            if host.distro() not in vdsm_dists:
-                vdsm_dists.append(host.distro())
+        vdsm_dists = sorted({host.distro() for host in hosts})
 
-        all_dists = list(set(engine_dists + vdsm_dists))
+        all_dists = list(set(engine_dists) | set(vdsm_dists))
 
         repos = []
         jobs = []
@@ -320,6 +510,7 @@ class OvirtPrefix(testenv.Prefix):
                         rpm_repo,
                         reposync_yum_config,
                         repos,
+                        self.paths.logs(),
                     )
                 )
 
@@ -332,6 +523,7 @@ class OvirtPrefix(testenv.Prefix):
                     vdsm_dir=vdsm_dir,
                     output_dir=self.paths.build_dir('vdsm'),
                     dists=vdsm_dists,
+                    log_dir=self.paths.logs(),
                 )
             )
 
@@ -342,6 +534,7 @@ class OvirtPrefix(testenv.Prefix):
                     engine_dir=engine_dir,
                     output_dir=self.paths.build_dir('ovirt-engine'),
                     dists=engine_dists,
+                    log_dir=self.paths.logs(),
                     build_gwt=engine_build_gwt,
                 ),
             )
@@ -349,14 +542,17 @@ class OvirtPrefix(testenv.Prefix):
         if vdsm_jsonrpc_java_dir and engine_dists:
             jobs.append(
                 functools.partial(
-                    _build_engine_rpms,
-                    engine_dir=engine_dir,
-                    output_dir=self.paths.build_dir('ovirt-engine'),
+                    _build_vdsm_jsonrpc_java_rpms,
+                    source_dir=vdsm_jsonrpc_java_dir,
+                    output_dir=self.paths.build_dir('vdsm-jsonrpc-java'),
                     dists=engine_dists,
-                    build_gwt=engine_build_gwt,
+                    log_dir=self.paths.logs(),
                 ),
             )
 
+        # The jobs spend their time waiting on reposync/mock child processes,
+        # which does not hold the GIL, so threads are enough to run them in
+        # parallel
         vt = testenv.utils.VectorThread(jobs)
         vt.start_all()
         if engine_dir:
@@ -404,16 +600,21 @@ class OvirtPrefix(testenv.Prefix):
 
     def _deploy_host(self, host):
         host.wait_for_ssh()
-        for script in host.metadata.get('ovirt-scripts', []):
-            ret, _, _ = host.ssh_script(script, show_output=False)
-            if ret != 0:
-                raise RuntimeError(
-                    '%s failed with status %d on %s' % (
-                        script,
-                        ret,
-                        host.name(),
-                    ),
+        scripts = host.metadata.get('ovirt-scripts', [])
+
+        # Scripts are run in order unless the host says they are independent
+        if host.metadata.get('ovirt-scripts-parallel', False):
+            vt = testenv.utils.VectorThread(
+                testenv.utils.func_vector(
+                    _run_deploy_script,
+                    [(host, script) for script in scripts],
                 )
+            )
+            vt.start_all()
+            vt.join_all()
+        else:
+            for script in scripts:
+                _run_deploy_script(host, script)
 
     @_with_repo_server
     def deploy(self):
@@ -454,10 +655,10 @@ class OvirtPrefix(testenv.Prefix):
         super(OvirtPrefix, self).stop()
 
     def collect_artifacts(self, output_dir):
-        os.makedirs(output_dir)
+        testenv.utils.mkdir_p(output_dir)
 
         def _collect_artifacts(vm, path):
-            os.makedirs(path)
+            testenv.utils.mkdir_p(path)
             vm.collect_artifacts(path)
 
         vt = testenv.utils.VectorThread(
@@ -150,9 +150,9 @@ def discard_older_rpms(rpms):
 
 
 def verify_repo(repo_url, path, whitelist=None, blacklist=None):
-    downloaded_rpms = []
+    downloaded_rpms = set()
     for root, dirs, files in os.walk(path):
-        downloaded_rpms.extend([f for f in files if f.endswith('.rpm')])
+        downloaded_rpms.update(f for f in files if f.endswith('.rpm'))
 
     for rpm in discard_older_rpms(
         get_packages(repo_url, whitelist, blacklist)
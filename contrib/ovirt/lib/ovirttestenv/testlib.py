@@ -20,6 +20,7 @@
 import datetime
 import functools
 import os
+import time
 
 import nose.plugins
 from nose.plugins.skip import SkipTest
@@ -30,6 +31,7 @@ import ovirttestenv
 
 SHORT_TIMEOUT = 3 * 60
 LONG_TIMEOUT = 10 * 60
+POLL_INTERVAL = 1
 
 
 _test_prefix = None
@@ -147,6 +149,7 @@ def assert_true_within(func, timeout):
                     return
             except Exception:
                 pass
+            time.sleep(POLL_INTERVAL)
     raise AssertionError('Timed out')
 
 
@@ -19,6 +19,8 @@
 #
 import BaseHTTPServer
 import contextlib
+import errno
+import fcntl
 import os
 import threading
 import SimpleHTTPServer
@@ -28,16 +30,35 @@ import testenv.utils as utils
 import constants
 
 
-def run_command(command, **kwargs):
+def _add_libexec_to_path():
     # add libexec to PATH if needed
     if constants.LIBEXEC_DIR not in os.environ['PATH'].split(':'):
         os.environ['PATH'] = '%s:%s' % (
             constants.LIBEXEC_DIR,
             os.environ['PATH']
         )
+
+
+def run_command(command, **kwargs):
+    _add_libexec_to_path()
     return utils.run_command(command, **kwargs)
 
 
+def run_command_to_file(command, log_path, **kwargs):
+    _add_libexec_to_path()
+    return utils.run_command_to_file(command, log_path, **kwargs)
+
+
+def try_flock(fd, operation):
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
 def _BetterHTTPRequestHandler(root_dir):
     _SimpleHTTPRequestHandler = SimpleHTTPServer.SimpleHTTPRequestHandler
 
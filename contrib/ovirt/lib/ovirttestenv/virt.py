@@ -75,6 +75,9 @@ class EngineVM(TestVM):
 
     def stop(self):
         TestVM.stop(self)
+        self.invalidate_api()
+
+    def invalidate_api(self):
         self._api = None
 
     def _artifact_paths(self):
@@ -40,14 +40,14 @@ echo "Build for following dists: ${DISTS?}"
 
 cd "${SOURCE_DIR?}"
 rm -rf "${PWD}/rpmbuild"
-rm -rf "${PWD}/*.tar.gz"
+rm -rf "${PWD}"/*.tar.gz
 
 ./autogen.sh
 ./configure --with-dist-only
 make dist
 rpmbuild -ts *.tar.gz -D "_topdir ${PWD}/rpmbuild"
 
-SRPM_PATH=$(realpath "${PWD}/rpmbuild/SRPMS/*.src.rpm")
+SRPM_PATH=$(realpath "${PWD}"/rpmbuild/SRPMS/*.src.rpm)
 
 for DIST in ${DISTS?};
 do
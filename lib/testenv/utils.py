@@ -19,6 +19,7 @@
 #
 import array
 import collections
+import errno
 import fcntl
 import json
 import logging
@@ -91,9 +92,7 @@ class CommandStatus(_CommandStatus):
         return self.code
 
 
-def run_command(command, input_data=None, env=None, **kwargs):
-    logging.debug('Running command: %s', str(command))
-
+def _command_env(env):
     # add libexec to PATH if needed
     if constants.LIBEXEC_DIR not in os.environ['PATH'].split(':'):
         os.environ['PATH'] = '%s:%s' % (
@@ -101,12 +100,8 @@ def run_command(command, input_data=None, env=None, **kwargs):
             os.environ['PATH']
         )
 
-    if input_data:
-        kwargs['stdin'] = subprocess.PIPE
-
-    if env is None:
-        env = os.environ.copy()
-    else:
+    # Without an explicit env the child just inherits os.environ
+    if env is not None:
         env['PATH'] = ':'.join(
             list(
                 set(
@@ -116,6 +111,22 @@ def run_command(command, input_data=None, env=None, **kwargs):
                 ),
             ),
         )
+    return env
+
+
+def _read_tail(path, size):
+    with open(path) as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - size))
+        return f.read()
+
+
+def run_command(command, input_data=None, env=None, **kwargs):
+    logging.debug('Running command: %s', str(command))
+
+    env = _command_env(env)
+    if input_data:
+        kwargs['stdin'] = subprocess.PIPE
 
     popen = subprocess.Popen(
         command,
@@ -133,6 +144,38 @@ def run_command(command, input_data=None, env=None, **kwargs):
     return CommandStatus(popen.returncode, out, err)
 
 
+def run_command_to_file(
+    command,
+    log_path,
+    tail_size=64 * 1024,
+    env=None,
+    **kwargs
+):
+    '''
+    Like run_command, but stdout and stderr go straight to log_path instead
+    of being kept in memory. On failure the returned status holds the last
+    tail_size bytes of the log as its output.
+    '''
+    logging.debug('Running command: %s, logging to %s', str(command), log_path)
+
+    env = _command_env(env)
+    with open(log_path, 'w') as log:
+        popen = subprocess.Popen(
+            command,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=env,
+            **kwargs
+        )
+        popen.wait()
+    logging.debug('command exit with %d', popen.returncode)
+
+    out = ''
+    if popen.returncode:
+        out = _read_tail(log_path, tail_size)
+    return CommandStatus(popen.returncode, out, '')
+
+
 def service_is_enabled(name):
     ret, out, _ = run_command(['systemctl', 'is-enabled', name])
     if ret == 0 and out.strip() == 'enabled':
@@ -205,6 +248,14 @@ class EggTimer:
         return (time.time() - self.start_time) > self.timeout
 
 
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
 def setup_logging(logdir):
     if not os.path.exists(logdir):
         os.mkdir(logdir)
@@ -0,0 +1,71 @@
+# Copyright 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+import os
+import shutil
+import tempfile
+
+from nose import tools
+
+from testenv import utils
+
+tempdir = None
+
+
+def setup_tempdir():
+    global tempdir
+    tempdir = tempfile.mkdtemp()
+
+
+def teardown_tempdir():
+    shutil.rmtree(tempdir)
+
+
+@tools.with_setup(setup_tempdir, teardown_tempdir)
+def test_run_command_to_file_success():
+    log_path = os.path.join(tempdir, 'log')
+    ret = utils.run_command_to_file(
+        ['sh', '-c', 'echo out; echo err >&2'],
+        log_path,
+    )
+
+    tools.assert_equal(ret.code, 0)
+    tools.assert_equal(ret.out, '')
+    with open(log_path) as f:
+        tools.assert_equal(sorted(f.read().split()), ['err', 'out'])
+
+
+@tools.with_setup(setup_tempdir, teardown_tempdir)
+def test_run_command_to_file_failure_tail():
+    log_path = os.path.join(tempdir, 'log')
+    ret = utils.run_command_to_file(
+        ['sh', '-c', 'echo 0123456789; exit 3'],
+        log_path,
+        tail_size=5,
+    )
+
+    tools.assert_equal(ret.code, 3)
+    tools.assert_equal(ret.out, '6789\n')
+
+
+@tools.with_setup(setup_tempdir, teardown_tempdir)
+def test_mkdir_p():
+    path = os.path.join(tempdir, 'a', 'b')
+    utils.mkdir_p(path)
+    utils.mkdir_p(path)
+
+    tools.assert_true(os.path.isdir(path))